@@ -1,9 +1,9 @@
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, WaiterError
 import sys
-import time
 import datetime
-import tabulate
+from concurrent.futures import ThreadPoolExecutor
 
 
 def display_data(data):
@@ -13,32 +13,22 @@ def display_data(data):
     Parameters:
         data (list): A list of dictionaries. The keys of the dictionaries will be used as the headers.
     """
-    try:
-        # Get the keys from the first dictionary in the list
-        headers = data[0].keys()
-        # Create a list of lists with the values in the correct order
-        rows = [[item[header] for header in headers] for item in data]
-        print(tabulate.tabulate(rows, headers=headers))
-    except:
-        pass
-
-
-def get_tag_value(tag_key, tags):
-    """
-    Get the value of a tag with the specified key from a list of tags.
-    
-    Parameters:
-        tag_key (str): The key of the tag to get the value of.
-        tags (list): The list of tags to search through.
-    
-    Returns:
-        str: The value of the tag with the specified key, or 'N/A' if the tag is not found.
-    """
-    if isinstance(tags, list):
-        for tag in tags:
-            if tag['Key'] == tag_key:
-                return tag['Value']
-    return 'N/A'
+    # Nothing to display for an empty list
+    if not data:
+        return
+    # Get the keys from the first dictionary in the list
+    headers = list(data[0].keys())
+    # Convert the values to strings, showing missing values as empty cells
+    rows = [['' if item[header] is None else str(item[header]) for header in headers] for item in data]
+    # Get the width of each column from the longest value or header
+    widths = [max(len(str(header)), *(len(row[i]) for row in rows)) for i, header in enumerate(headers)]
+    # Build the header, separator and data lines, then write them at once
+    lines = [
+        '  '.join(str(header).ljust(width) for header, width in zip(headers, widths)),
+        '  '.join('-' * width for width in widths)
+    ]
+    lines.extend('  '.join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+    sys.stdout.write('\n'.join(line.rstrip() for line in lines) + '\n')
 
 
 def get_protections_status(ec2_client, instance_id):
@@ -94,54 +84,80 @@ def disable_instance_protections(ec2_client, instance_id, disable_termination=Fa
         )
 
 
-def list_instances(ec2_client, tags):
+def iter_instances(ec2_client, tags, states=('running', 'stopping', 'stopped')):
+    """
+    Iterate over the instances in the specified region with the specified tags, one page at a time.
+    
+    Parameters:
+        ec2_client (boto3.client): The EC2 client to use for the operation.
+        tags (list): The list of tags to filter the instances by.
+        states (tuple): The instance states to filter the instances by (default: running, stopping and stopped).
+    
+    Yields:
+        dict: A dictionary containing the ID, name, state, and protections status of an instance.
+    """
+    # Filter the instance states on the server side
+    filters = tags + [{'Name': 'instance-state-name', 'Values': list(states)}]
+    # Use a paginator so the filters are kept on every page request
+    paginator = ec2_client.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 500})
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        for page in page_iterator:
+            instances = []
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    # Map the tag keys to their values for direct lookups
+                    instance_tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                    instance_name = instance_tags.get('Name', 'N/A')
+                    instances.append(
+                        {
+                            'name': instance_name,
+                            'id': instance['InstanceId'],
+                            'state': instance['State']['Name']
+                        })
+            # Get the protections status of the instances in this page concurrently
+            protections_statuses = executor.map(
+                lambda instance: get_protections_status(ec2_client, instance['id']),
+                instances
+            )
+            for instance, protections_status in zip(instances, protections_statuses):
+                instance['termination_protection'] = protections_status['termination']
+                instance['stop_protection'] = protections_status['stop']
+                yield instance
+
+
+def list_instances(ec2_client, tags, states=('running', 'stopping', 'stopped')):
     """
     Get a list of instances in the specified region with the specified tags.
     
     Parameters:
         ec2_client (boto3.client): The EC2 client to use for the operation.
         tags (list): The list of tags to filter the instances by.
+        states (tuple): The instance states to filter the instances by (default: running, stopping and stopped).
     
     Returns:
-        list: A list of dictionaries, each containing the ID, name, and state of an instance.
+        list: A list of dictionaries, each containing the ID, name, state, and protections status of an instance.
     """
-    response = ec2_client.describe_instances(Filters=tags)
-    reservations = response['Reservations']
-    while 'NextToken' in response:
-        response = ec2_client.describe_instances(NextToken=response['NextToken'])
-        reservations.extend(response['Reservations'])
-    instances = []
-    for reservation in reservations:
-        for instance in reservation['Instances']:
-            instance_name = get_tag_value('Name', instance.get('Tags', []))
-            protections_status = get_protections_status(ec2_client, instance['InstanceId'])
-            if instance['State']['Name'] in ['running', 'stopping', 'stopped']:
-                instances.append(
-                    {
-                        'name': instance_name,
-                        'id': instance['InstanceId'],
-                        'state': instance['State']['Name'],
-                        'termination_protection': protections_status['termination'],
-                        'stop_protection': protections_status['stop']
-                    })
-    return instances
-
-
-def create_ami(ec2_client, instance):
+    return list(iter_instances(ec2_client, tags, states))
+
+
+def create_ami(ec2_client, instance, created_at):
     """
     Create an Amazon Machine Image (AMI) from an instance.
 
     Parameters:
     ec2_client (boto3.client): The EC2 client to use for the operation.
     instance (dict): A dictionary containing the ID and name of the instance to create the AMI from.
+    created_at (datetime.datetime): The time of the run, used in the AMI name and description.
 
     Returns:
     dict: A dictionary containing the instance information of the created AMI.
     """
     # Generate the AMI name and description
-    now = datetime.datetime.now()
-    ami_name = f'EC2DeletionScript_{instance["id"]}_{now.strftime("%Y%m%d%H%M%S")}'
-    ami_description = f'AMI created on {now.strftime("%Y-%m-%d %H:%M:%S")} by EC2 deletion script.'
+    ami_name = f'EC2DeletionScript_{instance["id"]}_{created_at.strftime("%Y%m%d%H%M%S")}'
+    ami_description = f'AMI created on {created_at.strftime("%Y-%m-%d %H:%M:%S")} by EC2 deletion script.'
+    # No AMI ID until the AMI is created
+    ami_id = None
     # Creating the AMI
     try:
         print(f'Creating AMI from instance {instance["name"]} ({instance["id"]})...')
@@ -152,31 +168,17 @@ def create_ami(ec2_client, instance):
             NoReboot=True,
             DryRun=False
         )
-    # If fails, retry once
+    # Transient errors are already retried by the client, so skip the instance if it still fails
     except ClientError as e:
-        print('Creating AMI is failed, retrying...')
-        print(e)
-        time.sleep(5)
-        try:
-            print(f'Creating AMI from instance {instance["name"]} ({instance["id"]})...')
-            response = ec2_client.create_image(
-                InstanceId=instance['id'],
-                Name=ami_name,
-                Description=ami_description,
-                NoReboot=True,
-                DryRun=False
-            )
-        except ClientError as e:
-            print('Creating AMI is failed, again...')
-            print(e)
-            print(f'Skipped this instance {instance["name"]} ({instance["id"]}).')
-            return {
-                'instance_name': instance['name'],
-                'instance_id': instance['id'],
-                'ami_id': ami_id,
-                'ami_name': ami_name,
-                'backup_completed': False
-            }
+        print(f'Creating AMI is failed for {instance["name"]} ({instance["id"]}): {e}')
+        print(f'Skipped this instance {instance["name"]} ({instance["id"]}).')
+        return {
+            'instance_name': instance['name'],
+            'instance_id': instance['id'],
+            'ami_id': ami_id,
+            'ami_name': ami_name,
+            'backup_completed': False
+        }
 
     # Get the AMI ID
     ami_id = response['ImageId']
@@ -186,7 +188,7 @@ def create_ami(ec2_client, instance):
         Resources=[ami_id],
         Tags=[{'Key': 'Name', 'Value': ami_name}]
     )
-    print(f'AMI creation complete.')
+    print(f'AMI creation complete: {instance["name"]} ({instance["id"]}).')
     return {
         'instance_name': instance['name'],
         'instance_id': instance['id'],
@@ -196,67 +198,96 @@ def create_ami(ec2_client, instance):
     }
 
 
-def backup_instances(ec2_client, instances):
+def backup_instances(ec2_client, instances, created_at):
     """
     Backup instances by creating Amazon Machine Images (AMIs).
 
     Parameters:
     ec2_client (boto3.client): The EC2 client to use for the operations.
     instances (list): A list of dictionaries, each containing the ID and name of an instance to create an AMI from.
+    created_at (datetime.datetime): The time of the run, shared by all the AMIs created.
 
     Returns:
     list: A list of dictionaries, each containing the instance ID, instance name, and status of the AMI creation.
     """
-    results = []
-    for instance in instances:
-        result = create_ami(ec2_client, instance)
-        results.append(result)
+    if not instances:
+        return []
+    # Create the AMIs concurrently, keeping the results in the same order as the instances
+    with ThreadPoolExecutor(max_workers=min(10, len(instances))) as executor:
+        results = list(executor.map(lambda instance: create_ami(ec2_client, instance, created_at), instances))
     return results
 
 
-def terminate_instances(ec2_client, instances):
+def terminate_instances(ec2_client, instances, wait=False):
     """
     Terminate a list of instances.
 
     Parameters:
     ec2_client (boto3.client): The EC2 client to use for the operation.
     instances (list): A list of dictionaries, each containing the ID and name of an instance to terminate.
+    wait (bool): Set to True to wait until the instances are terminated (default: False).
 
     Returns:
     list: A list of dictionaries, each containing the instance ID, instance name, and status of the termination.
     """
+    # Map the instance IDs to their names to build the results
+    instance_names = {instance['instance_id']: instance['instance_name'] for instance in instances}
+    instance_ids = list(instance_names)
     results = []
-    # Terminate the instances
-    for instance in instances:
-        status = False
+    all_terminated = []
+    # Terminate the instances in batches of up to 1000 (API limit per call)
+    for i in range(0, len(instance_ids), 1000):
+        batch = instance_ids[i:i + 1000]
+        for instance_id in batch:
+            print(f'Terminating {instance_names[instance_id]} ({instance_id})...')
         try:
-            print(f'Terminating {instance["instance_name"]} ({instance["instance_id"]})...')
-            response = ec2_client.terminate_instances(InstanceIds=[instance['instance_id']])
-            time.sleep(3)
-            result = response['TerminatingInstances'][0]
-            # If the instance is successfully shutting down, change the status to True
-            if result['CurrentState']['Name'] == 'shutting-down':
-                print('EC2 termination complete.')
-                status = True
+            response = ec2_client.terminate_instances(InstanceIds=batch)
+            terminating_instances = response['TerminatingInstances']
+        # One failing instance (e.g. protected) fails the whole call, while some others may still be
+        # terminated, so terminate the instances of this batch one by one to get their real status
+        except ClientError as e:
+            print(f'Failed to terminate the batch, retrying one instance at a time: {e}')
+            terminating_instances = []
+            for instance_id in batch:
+                try:
+                    response = ec2_client.terminate_instances(InstanceIds=[instance_id])
+                    terminating_instances.extend(response['TerminatingInstances'])
+                except ClientError as e:
+                    print(f'Failed to terminate {instance_names[instance_id]} ({instance_id}): {e}')
+        # If the instance is shutting down (or already terminated), add it to the terminated instances
+        terminated = set()
+        for result in terminating_instances:
+            if result['CurrentState']['Name'] in ['shutting-down', 'terminated']:
+                terminated.add(result['InstanceId'])
+        for instance_id in batch:
+            status = instance_id in terminated
+            if status:
+                print(f'EC2 termination complete: {instance_names[instance_id]} ({instance_id}).')
             else:
-                print('Failed to terminate.')
-            results.append({
-                'instance_name': instance["instance_name"],
-                'instance_id': instance["instance_id"],
-                'terminate_completed': status})
-        except Exception as e:
-            print('Failed to terminate.')
+                print(f'Failed to terminate: {instance_names[instance_id]} ({instance_id}).')
             results.append({
-                'instance_name': instance["instance_name"],
-                'instance_id': instance["instance_id"],
+                'instance_name': instance_names[instance_id],
+                'instance_id': instance_id,
                 'terminate_completed': status})
+        all_terminated.extend(instance_id for instance_id in batch if instance_id in terminated)
+    # Wait once for all the instances instead of after each one
+    if wait and all_terminated:
+        print('Waiting for the instances to be terminated...')
+        try:
+            waiter = ec2_client.get_waiter('instance_terminated')
+            waiter.wait(InstanceIds=all_terminated)
+            print('All instances are terminated.')
+        except WaiterError as e:
+            print(f'Failed waiting for the instances to be terminated: {e}')
     return results
 
 
 def main():
     print('Starting EC2 deletion script...')
-    # Set up the EC2 client
-    ec2_client = boto3.client('ec2')
+    # Set up the EC2 client with adaptive retries and enough connections for the concurrent calls
+    config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=50)
+    session = boto3.session.Session()
+    ec2_client = session.client('ec2', config=config)
 
     # Set the tags to filter the instances
     tags = [
@@ -282,14 +313,20 @@ def main():
             print('Found some protections are enabled on some instances.')
             user_input = input('Are you want to disable "all protections" for all instances? (y/n)\n> ')
             if user_input.lower() == 'y':
+                # Only disable the protections that are enabled, one task per instance and protection
+                tasks = []
                 for instance in instances:
-                    disable_instance_protections(
-                        ec2_client, instance['id'],
-                        disable_termination=True, disable_stop=True
-                    )
-                # Get a list of instances to check protections status
-                print('\nListing instances (again)...\n')
-                instances = list_instances(ec2_client, tags)
+                    if instance['termination_protection']:
+                        tasks.append({'instance_id': instance['id'], 'disable_termination': True})
+                    if instance['stop_protection']:
+                        tasks.append({'instance_id': instance['id'], 'disable_stop': True})
+                with ThreadPoolExecutor(max_workers=min(10, len(tasks))) as executor:
+                    list(executor.map(lambda task: disable_instance_protections(ec2_client, **task), tasks))
+                # The protections are now disabled, update the instances without listing them again
+                for instance in instances:
+                    instance['termination_protection'] = False
+                    instance['stop_protection'] = False
+                print('\nProtections disabled.\n')
                 display_data(instances)
             else:
                 print('Come back if you already disabled protections on all instances.')
@@ -302,7 +339,9 @@ def main():
 
         # Create AMIs of the instances
         print('\nBacking up instances...\n')
-        backup_results = backup_instances(ec2_client, instances)
+        # Use the same timestamp for all the AMIs created in this run, taken right before creating them
+        created_at = datetime.datetime.now()
+        backup_results = backup_instances(ec2_client, instances, created_at)
         print('')
         display_data(backup_results)
 
@@ -311,7 +350,13 @@ def main():
 
         # Terminate the instances that have been successfully backed up
         print('\nTerminating instances that have already been backed up...\n')
-        terminate_results = terminate_instances(ec2_client, backup_results)
+        safe_to_terminate = []
+        for result in backup_results:
+            if result['backup_completed']:
+                safe_to_terminate.append(result)
+            else:
+                print(f'Skipped {result["instance_name"]} ({result["instance_id"]}), it has not been backed up.')
+        terminate_results = terminate_instances(ec2_client, safe_to_terminate)
         print('')
         display_data(terminate_results)
 